@@ -1,26 +1,47 @@
 # app.py - OPTIMIZED VERSION
 
-from flask import Flask, render_template, request, jsonify, send_file
+import os
+from dotenv import load_dotenv, set_key, find_dotenv
+
+load_dotenv()
+
+# `WORKER=gevent python app.py`: patch socket/thread trước khi import requests, redis...
+if __name__ == '__main__' and os.getenv('WORKER') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, render_template, request, jsonify, send_file
+from flask.json.provider import JSONProvider
 from flask_limiter import Limiter
+from werkzeug.wsgi import FileWrapper
 from flask_limiter.util import get_remote_address
-import os
+import io
 import re
+import sys
+import errno
+import shutil
 import requests
-from dotenv import load_dotenv, set_key, find_dotenv
+from requests.adapters import HTTPAdapter
 import tempfile
 import time
 import hashlib
 import logging
-from functools import wraps
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import json
+try:
+    import orjson
+except ImportError:  # orjson là optional, thiếu thì fallback về stdlib json
+    orjson = None
 import random
 import threading
 import atexit
+import heapq
+import itertools
 from datetime import datetime, timedelta
-from collections import deque
 import redis
-from urllib.parse import quote
+from cachetools import TTLCache
+from urllib.parse import quote, urlencode
 
 # ==================== CONFIGURATION ====================
 logging.basicConfig(
@@ -30,8 +51,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
 app = Flask(__name__,
             template_folder='statis',
             static_folder='statis',
@@ -39,24 +58,63 @@ app = Flask(__name__,
 
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(32))
+MAX_SUBTITLE_ENTRIES = 50000
+BATCH_JSON_MAX_TEXTS = 100  # /translate-batch-json: tối đa số text mỗi request
+
+# JSON cho HTTP body (bytes vào/ra): orjson nếu có, không thì stdlib json
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+class OrjsonProvider(JSONProvider):
+    """jsonify/request.json qua orjson (nhanh hơn stdlib json 3-10x)"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                                        mimetype='application/json')
 
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Không dùng default_limits: các route API đã có limit riêng, "/" + static không cần đếm
+# Nhiều worker / nhiều instance: RATE_LIMIT_STORAGE=redis://... để dùng chung bộ đếm
+# (Redis lỗi thì tạm fallback về memory thay vì trả 500)
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"
+    strategy="fixed-window",
+    storage_uri=os.getenv('RATE_LIMIT_STORAGE') or "memory://",
+    in_memory_fallback_enabled=True
 )
+limiter.exempt(app.view_functions['static'])
 
 # ==================== REDIS SETUP ====================
+# Pool dùng chung cho mọi worker thread: hết connection thì chờ (tối đa 2s) thay vì mở thêm
+redis_pool = redis.BlockingConnectionPool(
+    host=os.getenv('REDIS_HOST', 'localhost'),
+    port=int(os.getenv('REDIS_PORT', 6379)),
+    db=0,
+    max_connections=32,
+    timeout=2,
+    decode_responses=True,
+    socket_timeout=2,
+    socket_connect_timeout=2
+)
+atexit.register(redis_pool.disconnect)
+
 try:
-    redis_client = redis.Redis(
-        host=os.getenv('REDIS_HOST', 'localhost'),
-        port=int(os.getenv('REDIS_PORT', 6379)),
-        db=0,
-        decode_responses=True,
-        socket_timeout=2,
-        socket_connect_timeout=2
-    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()
     REDIS_AVAILABLE = True
     logger.info("✅ Redis connected successfully")
@@ -65,16 +123,107 @@ except Exception as e:
     redis_client = None
     REDIS_AVAILABLE = False
 
-# Fallback in-memory cache
-MEMORY_CACHE = {}
-CACHE_MAX_SIZE = 5000
+# Fallback in-memory cache (LRU + TTL, dùng chung giữa các worker thread)
+# Giới hạn theo byte chứ không theo số entry: 5000 dòng có thể là 1MB (tên nhân vật) hoặc 50MB (thoại dài)
+CACHE_MAX_BYTES = int(float(os.getenv('CACHE_MB') or 64) * 1024 * 1024)  # <= 0: tắt memory cache
+CACHE_KEY_MEMO_SIZE = 5000  # Số cache key Redis được memo (get_cache_key)
+if os.getenv('CACHE_SIZE'):
+    # CACHE_SIZE (số entry) đã bỏ: dung lượng memory cache giờ tính theo byte
+    logger.warning(f"⚠️ CACHE_SIZE is deprecated and ignored, use CACHE_MB (memory cache now {CACHE_MAX_BYTES >> 20}MB)")
 CACHE_TTL = 7 * 24 * 3600  # 7 days
+CACHE_ENTRY_OVERHEAD = 200  # tuple key + ngôn ngữ/engine + node LRU/TTL của cachetools
+
+def cache_entry_size(translation):
+    """Ước lượng byte của 1 entry: cachetools chỉ đưa value, text gốc trong key coi như dài tương đương"""
+    return 2 * sys.getsizeof(translation) + CACHE_ENTRY_OVERHEAD
+
+MEMORY_CACHE = TTLCache(maxsize=max(CACHE_MAX_BYTES, 0), ttl=CACHE_TTL, getsizeof=cache_entry_size)
+memory_cache_lock = threading.Lock()  # Không lồng nhau -> Lock thường, rẻ hơn RLock
+
+def memory_cache_put(entries):
+    """Ghi (key, translation) vào memory cache, gọi trong memory_cache_lock"""
+    if CACHE_MAX_BYTES <= 0:
+        return
+    for key, translation in entries:
+        try:
+            MEMORY_CACHE[key] = translation
+        except ValueError:
+            pass  # Entry lớn hơn cả dung lượng cache (CACHE_MB quá nhỏ) -> không giữ trong RAM
+
+# Không có Redis thì memory cache mất khi restart -> CACHE_FILE cho phép lưu ra đĩa lúc tắt, nạp lại lúc khởi động
+CACHE_FILE = os.getenv('CACHE_FILE')
+
+def load_memory_cache():
+    if not CACHE_FILE or not os.path.exists(CACHE_FILE):
+        return
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            snapshot = json_loads(f.read())
+        # TTLCache không nhận expiry riêng từng entry -> snapshot quá TTL thì bỏ cả file
+        if time.time() - snapshot.get('saved_at', 0) > CACHE_TTL:
+            return
+        with memory_cache_lock:
+            memory_cache_put((tuple(key), translation) for *key, translation in snapshot.get('items', []))
+        logger.info(f"Loaded {len(MEMORY_CACHE)} cached translations from {CACHE_FILE}")
+    except Exception as e:
+        logger.warning(f"Failed to load cache file: {e}")
+
+def save_memory_cache():
+    if not CACHE_FILE:
+        return
+    try:
+        with memory_cache_lock:
+            items = [[*key, translation] for key, translation in MEMORY_CACHE.items()]
+        tmp_path = f"{CACHE_FILE}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps({'saved_at': time.time(), 'items': items}))
+        os.replace(tmp_path, CACHE_FILE)
+    except Exception as e:
+        logger.warning(f"Failed to save cache file: {e}")
+
+load_memory_cache()
+atexit.register(save_memory_cache)
 
 # ==================== API ENDPOINTS ====================
 GROQ_API = "https://api.groq.com/openai/v1/chat/completions"
 GEMINI_API = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
 OPENAI_API = "https://api.openai.com/v1/chat/completions"
 
+# Số batch AI chạy song song cho mỗi provider (dùng chung giữa các job)
+# Override bằng GROQ_CONCURRENCY / OPENAI_CONCURRENCY / GEMINI_CONCURRENCY theo rate limit của tài khoản
+AI_CONCURRENCY = {
+    'groq': int(os.getenv('GROQ_CONCURRENCY') or 5),
+    'openai': int(os.getenv('OPENAI_CONCURRENCY') or 10),
+    'gemini': int(os.getenv('GEMINI_CONCURRENCY') or 3),
+}
+ai_semaphores = {provider: threading.Semaphore(n) for provider, n in AI_CONCURRENCY.items()}
+ai_executor = ThreadPoolExecutor(max_workers=sum(AI_CONCURRENCY.values()), thread_name_prefix='ai-')
+atexit.register(ai_executor.shutdown, wait=False)
+
+# Shared session cho AI providers: giữ keep-alive, không handshake TLS lại mỗi batch
+ai_session = requests.Session()
+ai_session.mount('https://', HTTPAdapter(pool_connections=len(AI_CONCURRENCY),
+                                         pool_maxsize=sum(AI_CONCURRENCY.values()), max_retries=0))
+ai_session.headers['Content-Type'] = 'application/json'  # Mọi provider đều gửi JSON
+atexit.register(ai_session.close)
+
+# ==================== REGEX (compile 1 lần) ====================
+# Mỗi mục "[i] ..." kéo dài tới "[j]" đầu dòng kế tiếp hoặc dòng trống đầu tiên -> giữ được bản dịch
+# nhiều dòng, nhưng ghi chú AI thêm sau dòng cuối ("\n\nNote: ...") không dính vào bản dịch
+BATCH_REPLY_RE = re.compile(r'^[ \t]*\[(\d+)\][ \t]*(.*?)(?=\n[ \t]*\[\d+\]|\n[ \t]*\n|\Z)',
+                            re.MULTILINE | re.DOTALL)
+SRT_INDEX_RE = re.compile(r'^\d+$')
+BATCH_INDEX_RE = re.compile(r'\[\d+\]')  # Marker "[j]" lọt vào giữa 1 mục = reply sai format
+RATELIMIT_RESET_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)?')  # "1m30.5s", "6ms", "2"
+LETTER_RE = re.compile(r'[^\W\d_]')  # Có ít nhất 1 chữ cái (mọi ngôn ngữ)
+SRT_TAG_WRAP_RE = re.compile(r'^((?:\s*(?:<[^>]+>|\{[^}]*\}))*)(.*?)((?:(?:<[^>]+>|\{[^}]*\})\s*)*)$', re.DOTALL)
+SRT_BLOCK_RE = re.compile(
+    r'^[ \t]*(\d+)[ \t]*\n'                 # index
+    r'[ \t]*([^\n]*-->[^\n]*)\n?'           # timing
+    r'((?:[ \t]*\S[^\n]*\n?)*)',             # text (tới dòng trống)
+    re.MULTILINE
+)
+
 # ==================== GOOGLE TRANSLATE CONFIG ====================
 lang_map = {
     'auto': 'auto', 'en': 'en', 'vi': 'vi', 'zh': 'zh-CN',
@@ -90,65 +239,179 @@ USER_AGENTS = [
     'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
 ]
+UA_HEADERS = [{'User-Agent': ua} for ua in USER_AGENTS]  # Dict header dựng sẵn, dùng lại
+UA_ROTATE_EVERY = 500
+
+# Mỗi worker thread giữ 1 UA, đổi sau mỗi UA_ROTATE_EVERY request
+# (không gọi random + tạo dict header mới cho từng request)
+ua_local = threading.local()
+
+def get_ua_headers():
+    count = getattr(ua_local, 'count', 0)
+    if count % UA_ROTATE_EVERY == 0:
+        ua_local.headers = random.choice(UA_HEADERS)
+    ua_local.count = count + 1
+    return ua_local.headers
+
+# Giới hạn số request Google đang bay, độc lập với số worker thread (override bằng GOOGLE_INFLIGHT)
+GOOGLE_MAX_INFLIGHT = int(os.getenv('GOOGLE_INFLIGHT') or 30)
+google_inflight = threading.Semaphore(GOOGLE_MAX_INFLIGHT)
+
+# Shared session: keep-alive connection pool cho tất cả worker threads
+# Pool đúng bằng số request đang bay -> mọi request tái sử dụng socket có sẵn,
+# không mở connection thừa rồi bỏ khi pool đầy
+google_session = requests.Session()
+google_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=GOOGLE_MAX_INFLIGHT,
+                                             pool_block=True, max_retries=0))
+google_session.headers.update({
+    'Accept': 'application/json',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate'
+})
+atexit.register(google_session.close)
+
+# Shared worker pool: threads được tái sử dụng giữa các job thay vì tạo mới mỗi request
+# Thuần I/O chờ 1 host -> số worker bằng số request được bay, không phụ thuộc CPU
+# (dưới gevent thread là greenlet nên gần như không tốn gì; override bằng GOOGLE_WORKERS)
+GOOGLE_MAX_WORKERS = int(os.getenv('GOOGLE_WORKERS') or GOOGLE_MAX_INFLIGHT)
+google_executor = ThreadPoolExecutor(max_workers=GOOGLE_MAX_WORKERS, thread_name_prefix='gtrans-')
+atexit.register(google_executor.shutdown, wait=False)
 
 # ==================== RATE LIMITING ====================
 class RateLimiter:
-    """Smart rate limiter để tránh bị Google chặn"""
+    """
+    Token bucket để tránh bị Google chặn: O(1) mỗi lần acquire, sleep ngoài lock
+    Hết token thì "đặt trước" (tokens âm) -> các thread chờ được xếp hàng đúng nhịp
+    max_requests <= 0 (vd GOOGLE_RPS=0): không giới hạn
+    """
     def __init__(self, max_requests=15, time_window=1.0):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = deque()
+        self.max_requests = max(1.0, max_requests)  # Burst ít nhất 1 request (rate lẻ như 0.5 req/s)
+        self.rate = max_requests / time_window
+        self.tokens = self.max_requests
+        self.last = time.monotonic()
         self.lock = threading.Lock()
     
     def acquire(self):
+        if self.rate <= 0:
+            return
         with self.lock:
-            now = time.time()
-            # Xóa requests cũ
-            while self.requests and self.requests[0] < now - self.time_window:
-                self.requests.popleft()
-            
-            if len(self.requests) >= self.max_requests:
-                sleep_time = self.time_window - (now - self.requests[0])
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-                    self.requests.popleft()
-            
-            self.requests.append(time.time())
+            now = time.monotonic()
+            self.tokens = min(self.max_requests, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait_time > 0:
+            time.sleep(wait_time)
 
-# Global rate limiter - 15 req/s (an toàn với Google)
-google_limiter = RateLimiter(max_requests=15, time_window=1.0)
+# Global rate limiter - mặc định 15 req/s (an toàn với Google), override bằng GOOGLE_RPS
+GOOGLE_RPS = float(os.getenv('GOOGLE_RPS') or 15)  # Nhận số lẻ, vd 0.5 = 1 request / 2s
+google_limiter = RateLimiter(max_requests=GOOGLE_RPS, time_window=1.0)
+
+# AI: giới hạn request/phút theo provider nếu có cấu hình (GROQ_RPM / OPENAI_RPM / GEMINI_RPM),
+# ngoài semaphore concurrency -> không gửi dồn rồi ăn 429
+ai_limiters = {}
+for provider in AI_CONCURRENCY:
+    rpm = os.getenv(f'{provider.upper()}_RPM')
+    if rpm:
+        ai_limiters[provider] = RateLimiter(max_requests=float(rpm), time_window=60.0)
+
+# Provider báo hết quota (429 / x-ratelimit-remaining-* = 0) -> mọi batch của provider đó cùng
+# chờ tới lúc reset, thay vì từng thread tự đụng 429 rồi retry lệch nhau
+ai_pause_until = {provider: 0.0 for provider in AI_CONCURRENCY}
+RESET_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, None: 1}
+
+def parse_reset_duration(value):
+    """Header x-ratelimit-reset-* của Groq/OpenAI ("1m30.5s", "6ms") -> số giây, None nếu không đọc được"""
+    if not value:
+        return None
+    parts = RATELIMIT_RESET_RE.findall(value)
+    return sum(float(n) * RESET_UNITS[unit or None] for n, unit in parts) if parts else None
+
+def update_provider_pause(provider, resp):
+    """Đọc header rate limit của response, trả về số giây phải chờ (None nếu không bị chặn)"""
+    headers = resp.headers
+    wait = parse_retry_after(resp) if resp.status_code == 429 else None
+    for kind in ('requests', 'tokens'):
+        if not wait and (resp.status_code == 429 or headers.get(f'x-ratelimit-remaining-{kind}') == '0'):
+            wait = parse_reset_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+    if wait:
+        # Ghi đè không cần lock: các thread chỉ đẩy mốc về sau, lệch vài ms không sao
+        ai_pause_until[provider] = max(ai_pause_until.get(provider, 0.0), time.monotonic() + wait)
+    return wait
+
+def wait_provider_pause(provider):
+    delay = ai_pause_until.get(provider, 0.0) - time.monotonic()
+    if delay > 0:
+        # Jitter để các batch đang chờ không bắn lại cùng 1 lúc
+        time.sleep(delay + random.uniform(0, 0.5))
 
 # ==================== PROGRESS TRACKING ====================
-current_progress = 0
-progress_lock = threading.Lock()
-current_mode = "Google Free"
-total_subtitles = 0
-processed_subtitles = 0
+class JobProgress:
+    """Tiến độ của 1 job dịch, /progress đọc trực tiếp không cần lock"""
+    __slots__ = ('total', 'done', 'mode', 'finished', 'lock')
+    
+    def __init__(self, mode="Google Free", total=0):
+        self.total = total
+        self.done = 0
+        self.mode = mode
+        self.finished = False
+        self.lock = threading.Lock()  # Chỉ dùng giữa các worker của job này
+    
+    def incr(self, n=1):
+        with self.lock:
+            self.done += n
+    
+    @property
+    def percent(self):
+        if self.finished:
+            return 100
+        return int(self.done * 100 / self.total) if self.total else 0
+
+# Job đang chạy (được thay bằng object mới mỗi lần /translate)
+current_job = JobProgress()
 
 # ==================== CACHING LAYER ====================
-def get_cache_key(text, source_lang, target_lang):
-    """Tạo cache key deterministic"""
+@lru_cache(maxsize=CACHE_KEY_MEMO_SIZE)
+def get_cache_key(text, source_lang, target_lang, engine='google'):
+    """
+    Tạo cache key deterministic cho Redis (engine khác google có namespace riêng)
+    blake2b nhanh hơn md5 với chuỗi ngắn; memo lại vì mỗi dòng cần key ở cả lúc get (MGET) lẫn save
+    """
     normalized = text.strip().lower()
-    return hashlib.md5(f"{normalized}:{source_lang}:{target_lang}".encode()).hexdigest()
+    raw = f"{normalized}:{source_lang}:{target_lang}"
+    if engine != 'google':
+        raw = f"{raw}:{engine}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
 
-def get_from_cache(text, source_lang, target_lang):
-    """Lấy từ Redis hoặc memory cache"""
-    cache_key = get_cache_key(text, source_lang, target_lang)
+def get_memory_key(text, source_lang, target_lang, engine='google'):
+    """Key cho memory cache: tuple hash trực tiếp, không cần MD5"""
+    return (text.strip().lower(), source_lang, target_lang, engine)
+
+def get_from_cache(text, source_lang, target_lang, engine='google'):
+    """Lấy từ memory LRU trước, miss mới hỏi Redis (chỉ lúc đó mới cần MD5 key)"""
+    memory_key = get_memory_key(text, source_lang, target_lang, engine)
+    with memory_cache_lock:
+        cached = MEMORY_CACHE.get(memory_key)
+    if cached:
+        return cached
     
     if REDIS_AVAILABLE:
         try:
-            cached = redis_client.get(f"trans:{cache_key}")
+            cached = redis_client.get(f"trans:{get_cache_key(text, source_lang, target_lang, engine)}")
             if cached:
+                # Promote vào memory LRU để lần sau khỏi round-trip Redis
+                with memory_cache_lock:
+                    memory_cache_put([(memory_key, cached)])
                 return cached
         except Exception as e:
             logger.warning(f"Redis get error: {e}")
     
-    # Fallback to memory
-    return MEMORY_CACHE.get(cache_key)
+    return None
 
-def save_to_cache(text, source_lang, target_lang, translation):
+def save_to_cache(text, source_lang, target_lang, translation, engine='google'):
     """Lưu vào Redis + memory cache"""
-    cache_key = get_cache_key(text, source_lang, target_lang)
+    cache_key = get_cache_key(text, source_lang, target_lang, engine)
     
     if REDIS_AVAILABLE:
         try:
@@ -156,69 +419,183 @@ def save_to_cache(text, source_lang, target_lang, translation):
         except Exception as e:
             logger.warning(f"Redis set error: {e}")
     
-    # Always save to memory as backup
-    if len(MEMORY_CACHE) >= CACHE_MAX_SIZE:
-        MEMORY_CACHE.pop(next(iter(MEMORY_CACHE)))
-    MEMORY_CACHE[cache_key] = translation
+    # Always save to memory as backup (TTLCache tự evict theo LRU)
+    memory_key = get_memory_key(text, source_lang, target_lang, engine)
+    with memory_cache_lock:
+        memory_cache_put([(memory_key, translation)])
 
-# ==================== GOOGLE TRANSLATE ENGINE ====================
-def google_translate_single(session, text, source_lang, target_lang, retry=0):
+def get_many_from_cache(texts, source_lang, target_lang, engine='google'):
     """
-    Single translation với smart retry
+    Tra cache cho cả list 1 lần: memory trước (1 lần lock), phần miss gom vào 1 Redis MGET
+    Trả về list cùng độ dài với texts, None ở chỗ miss
     """
-    # Check cache first
-    cached = get_from_cache(text, source_lang, target_lang)
-    if cached:
-        return cached, True  # (result, from_cache)
+    memory_keys = [get_memory_key(text, source_lang, target_lang, engine) for text in texts]
+    with memory_cache_lock:
+        results = [MEMORY_CACHE.get(key) for key in memory_keys]
     
-    # Rate limiting
-    google_limiter.acquire()
+    if REDIS_AVAILABLE:
+        missing = [i for i, cached in enumerate(results) if not cached]
+        if missing:
+            try:
+                values = redis_client.mget([f"trans:{get_cache_key(texts[i], source_lang, target_lang, engine)}"
+                                            for i in missing])
+                for i, cached in zip(missing, values):
+                    if cached:
+                        results[i] = cached
+                with memory_cache_lock:
+                    memory_cache_put((memory_keys[i], results[i]) for i in missing if results[i])
+            except Exception as e:
+                logger.warning(f"Redis mget error: {e}")
     
-    url = 'https://translate.googleapis.com/translate_a/single'
-    params = {
-        'client': 'gtx',
-        'sl': 'auto' if source_lang == 'auto' else lang_map.get(source_lang, 'auto'),
-        'tl': target_lang,
-        'dt': 't',
-        'ie': 'UTF-8',
-        'oe': 'UTF-8',
-        'q': text
-    }
+    return results
+
+def save_many_to_cache(pairs, source_lang, target_lang, engine='google'):
+    """Lưu nhiều (text, translation) 1 lần: Redis qua 1 pipeline, memory trong 1 lần lock"""
+    if not pairs:
+        return
     
+    if REDIS_AVAILABLE:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for text, translation in pairs:
+                pipe.setex(f"trans:{get_cache_key(text, source_lang, target_lang, engine)}", CACHE_TTL, translation)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis pipeline error: {e}")
+    
+    # Tính key ngoài lock, trong lock chỉ còn thao tác dict
+    entries = [(get_memory_key(text, source_lang, target_lang, engine), translation) for text, translation in pairs]
+    with memory_cache_lock:
+        memory_cache_put(entries)
+
+# ==================== GOOGLE TRANSLATE ENGINE ====================
+GOOGLE_TRANSLATE_URL = 'https://translate.googleapis.com/translate_a/single'
+GOOGLE_BATCH_SIZE = 20          # Số dòng tối đa trong 1 request
+GOOGLE_BATCH_MAX_CHARS = 5000   # q gửi trong body POST nên không bị giới hạn độ dài URL
+GOOGLE_BATCH_DELIMITER = '\n␞\n'
+
+@lru_cache(maxsize=64)
+def google_base_params(source_lang, target_lang):
+    """
+    Query string cố định cho cả job, resolve lang_map + urlencode 1 lần
+    (requests nhận params dạng str thì gắn thẳng vào URL, không encode lại mỗi request)
+    """
+    sl = 'auto' if source_lang == 'auto' else lang_map.get(source_lang, 'auto')
+    return urlencode((('client', 'gtx'), ('sl', sl), ('tl', target_lang),
+                      ('dt', 't'), ('ie', 'UTF-8'), ('oe', 'UTF-8')))
+
+def backoff_delay(attempt, base):
+    """Exponential backoff có jitter (x0.5-1.5) để các request không retry cùng lúc"""
+    return random.uniform(0.5, 1.5) * (2 ** attempt) * base
+
+def parse_retry_after(resp):
+    """Đọc header Retry-After (số giây), None nếu không có / không hợp lệ"""
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
     try:
-        resp = session.get(url, params=params, timeout=8)
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+class GoogleRateLimited(Exception):
+    """Google trả 429 - caller lên lịch retry thay vì sleep trong worker thread"""
+    def __init__(self, retry_after=None):
+        super().__init__('Google rate limited')
+        self.retry_after = retry_after
+
+def google_request(session, text, base_params, max_timeouts=2):
+    """
+    1 HTTP request tới Google với smart retry (vòng lặp, không đệ quy)
+    Trả về None nếu thất bại, raise GoogleRateLimited nếu bị 429 (caller tự lên lịch retry)
+    """
+    # POST: q nằm trong body (form-encoded), URL chỉ còn các tham số cố định
+    body = {'q': text}
+    
+    for attempt in range(max_timeouts + 1):
+        # Rate limiting
+        google_limiter.acquire()
         
-        if resp.status_code == 200:
-            data = resp.json()
-            result = ''.join([s[0] for s in data[0] if s[0]]).strip()
+        try:
+            # UA theo thread, không mutate headers của shared session
+            with google_inflight:
+                resp = session.post(GOOGLE_TRANSLATE_URL, params=base_params, data=body, timeout=8,
+                                    headers=get_ua_headers())
             
-            if result:
-                save_to_cache(text, source_lang, target_lang, result)
-                return result, False
-            return text, False
-        
-        elif resp.status_code == 429:
-            # Rate limited - wait longer
-            if retry < 3:
-                wait_time = (2 ** retry) * 5  # 5s, 10s, 20s
-                logger.warning(f"Rate limited, waiting {wait_time}s...")
-                time.sleep(wait_time)
-                return google_translate_single(session, text, source_lang, target_lang, retry + 1)
-        
-        resp.raise_for_status()
-        return text, False
-        
-    except requests.exceptions.Timeout:
-        if retry < 2:
-            time.sleep(1)
-            return google_translate_single(session, text, source_lang, target_lang, retry + 1)
-        return text, False
-        
-    except Exception as e:
-        logger.error(f"Translation error: {e}")
-        return text, False
+            if resp.status_code == 200:
+                data = json_loads(resp.content)
+                return ''.join([s[0] for s in data[0] if s[0]]).strip() or None
+            
+            elif resp.status_code == 429:
+                raise GoogleRateLimited(parse_retry_after(resp))
+            
+            resp.raise_for_status()
+            return None
+            
+        except requests.exceptions.Timeout:
+            if attempt < max_timeouts:
+                time.sleep(backoff_delay(attempt, 1))
+            
+        except GoogleRateLimited:
+            raise
+            
+        except Exception as e:
+            logger.error(f"Translation error: {e}")
+            return None
+    
+    return None
+
+def google_translate_single(session, text, source_lang, target_lang, base_params=None):
+    """
+    Single translation, check cache trước
+    """
+    cached = get_from_cache(text, source_lang, target_lang)
+    if cached:
+        return cached, True  # (result, from_cache)
+    
+    result = google_request(session, text, base_params or google_base_params(source_lang, target_lang))
+    if result:
+        save_to_cache(text, source_lang, target_lang, result)
+        return result, False
+    return text, False
+
+def google_translate_batch(session, texts, source_lang, target_lang, base_params=None, fallback=True):
+    """
+    Dịch nhiều dòng trong 1 request (nối bằng delimiter)
+    Số đoạn trả về bị lệch: fallback dịch từng dòng, hoặc trả về None nếu fallback=False
+    Request lỗi (HTTP error / hết timeout): giữ bản gốc, không chia nhỏ bắn thêm request vào host đang từ chối
+    """
+    base_params = base_params or google_base_params(source_lang, target_lang)
+    if len(texts) > 1:
+        result = google_request(session, GOOGLE_BATCH_DELIMITER.join(texts), base_params)
+        if not result:
+            logger.warning(f"Batch request failed, keeping {len(texts)} original lines")
+            return list(texts)
+        parts = [part.strip() for part in result.split(GOOGLE_BATCH_DELIMITER.strip())]
+        if len(parts) == len(texts) and all(parts):
+            save_many_to_cache(list(zip(texts, parts)), source_lang, target_lang)
+            return parts
+        logger.warning(f"Batch split mismatch ({len(parts)}/{len(texts)}), fallback to single")
+        if not fallback:
+            return None
+    
+    return [google_translate_single(session, text, source_lang, target_lang, base_params)[0] for text in texts]
 
-def translate_with_google_parallel(texts, source_lang, target_lang):
+def chunk_indices(indices, texts, max_items=GOOGLE_BATCH_SIZE, max_chars=GOOGLE_BATCH_MAX_CHARS):
+    """Gom index thành các nhóm theo số dòng và tổng số ký tự"""
+    chunks, current, current_chars = [], [], 0
+    for i in indices:
+        size = len(texts[i]) + len(GOOGLE_BATCH_DELIMITER)
+        if current and (len(current) >= max_items or current_chars + size > max_chars):
+            chunks.append(current)
+            current, current_chars = [], 0
+        current.append(i)
+        current_chars += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+def translate_with_google_parallel(texts, source_lang, target_lang, job=None):
     """
     OPTIMIZED parallel translation với:
     - Smart rate limiting
@@ -226,73 +603,102 @@ def translate_with_google_parallel(texts, source_lang, target_lang):
     - Adaptive worker pool
     - Batch processing
     """
-    global current_progress, processed_subtitles
-    
     total = len(texts)
     translations = [""] * total
-    processed_subtitles = 0
+    job = job or JobProgress(total=total)
     
-    # Pre-check cache để giảm workload
+    # Pre-check cache để giảm workload (1 lần MGET cho cả file thay vì N round-trip)
     cache_hits = 0
     cache_misses = []
     
-    for i, text in enumerate(texts):
-        cached = get_from_cache(text, source_lang, target_lang)
+    for i, cached in enumerate(get_many_from_cache(texts, source_lang, target_lang)):
         if cached:
             translations[i] = cached
             cache_hits += 1
-            processed_subtitles += 1
         else:
             cache_misses.append(i)
     
     logger.info(f"Cache stats: {cache_hits}/{total} hits ({cache_hits/total*100:.1f}%)")
     
-    if cache_hits > 0:
-        with progress_lock:
-            current_progress = int((processed_subtitles / total) * 100)
+    job.incr(cache_hits)
     
     if not cache_misses:
         logger.info("✅ All translations from cache!")
         return translations
     
-    # Chỉ dịch những dòng chưa có trong cache
-    def translate_single_with_retry(index):
-        text = texts[index]
-        session = requests.Session()
-        session.headers.update({
-            'User-Agent': random.choice(USER_AGENTS),
-            'Accept': 'application/json',
-            'Accept-Language': 'en-US,en;q=0.9'
-        })
-        
-        translated, from_cache = google_translate_single(session, text, source_lang, target_lang)
-        
-        # Update progress
-        with progress_lock:
-            global processed_subtitles
-            processed_subtitles += 1
-            current_progress = int((processed_subtitles / total) * 100)
-        
-        return index, translated
+    # Chỉ dịch những dòng chưa có trong cache, gom theo batch
+    base_params = google_base_params(source_lang, target_lang)
     
-    # Adaptive workers: ít hơn nếu ít dòng cần dịch
-    max_workers = min(10, max(3, len(cache_misses) // 10))
-    logger.info(f"Using {max_workers} workers for {len(cache_misses)} items")
+    def translate_chunk_with_retry(indices, attempt):
+        try:
+            results = google_translate_batch(google_session, [texts[i] for i in indices],
+                                             source_lang, target_lang, base_params, fallback=False)
+        except GoogleRateLimited as e:
+            if attempt < 3:
+                return 'retry', e.retry_after  # Trả thread về pool, chunk được lên lịch retry
+            logger.warning(f"Rate limited {attempt} times, keeping original lines")
+            results = [texts[i] for i in indices]
+        if results is None:
+            return 'split', None  # Số đoạn lệch delimiter -> chia đôi, chạy song song trên pool
+        job.incr(len(indices))
+        return 'done', results
+    
+    chunks = chunk_indices(cache_misses, texts)
+    logger.info(f"Using {min(GOOGLE_MAX_WORKERS, len(chunks))} workers for {len(cache_misses)} items ({len(chunks)} batches)")
+    
+    def submit(indices, attempt=0):
+        future = google_executor.submit(translate_chunk_with_retry, indices, attempt)
+        futures[future] = (indices, attempt)
+    
+    futures = {}
+    for indices in chunks:
+        submit(indices)
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(translate_single_with_retry, i): i 
-            for i in cache_misses
-        }
+    # Retry 429 theo deadline (heap) thay vì sleep trong worker:
+    # trong lúc chờ backoff, worker thread tiếp tục dịch các chunk khác
+    retry_heap = []
+    retry_seq = itertools.count()
+    
+    while futures or retry_heap:
+        timeout = max(0, retry_heap[0][0] - time.monotonic()) if retry_heap else None
+        if futures:
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            # Chỉ còn chunk chờ retry: wait(set()) trả về ngay -> vòng lặp quay 100% CPU
+            # (dưới gevent còn chặn mọi request khác), ngủ thẳng tới deadline gần nhất
+            time.sleep(timeout)
+            done = ()
         
-        for future in as_completed(futures):
+        for future in done:
+            indices, attempt = futures.pop(future)
             try:
-                index, translated = future.result()
-                translations[index] = translated
+                action, results = future.result()
             except Exception as e:
-                index = futures[future]
-                logger.error(f"Thread error at line {index+1}: {e}")
-                translations[index] = texts[index]
+                logger.error(f"Thread error at lines {indices[0]+1}-{indices[-1]+1}: {e}")
+                action, results = 'done', [texts[i] for i in indices]
+            
+            if action == 'split':
+                # Chia đôi thay vì tách hẳn từng dòng: nửa nào khớp delimiter vẫn đi 1 request,
+                # thường chỉ 1-2 dòng "xấu" làm lệch cả batch
+                mid = len(indices) // 2
+                submit(indices[:mid], attempt)
+                submit(indices[mid:], attempt)
+                continue
+            
+            if action == 'retry':
+                # Ưu tiên Retry-After của server, không có thì ~5s, 10s, 20s (có jitter)
+                wait_time = results if results is not None else backoff_delay(attempt, 5)
+                logger.warning(f"Rate limited, retrying {len(indices)} lines in {wait_time:.1f}s...")
+                heapq.heappush(retry_heap, (time.monotonic() + wait_time, next(retry_seq), indices, attempt + 1))
+                continue
+            
+            for index, translated in zip(indices, results):
+                translations[index] = translated
+        
+        now = time.monotonic()
+        while retry_heap and retry_heap[0][0] <= now:
+            _, _, indices, attempt = heapq.heappop(retry_heap)
+            submit(indices, attempt)
     
     success_count = sum(1 for t in translations if t)
     logger.info(f"Translation complete: {success_count}/{total} success")
@@ -300,9 +706,7 @@ def translate_with_google_parallel(texts, source_lang, target_lang):
     return translations
 
 # ==================== AI BATCH TRANSLATION ====================
-def translate_batch(texts, source_lang, target_lang, provider, api_key, retry_count=0):
-    combined = '\n'.join([f"[{i+1}] {text}" for i, text in enumerate(texts)])
-    prompt = f"""You are a professional subtitle translator.
+AI_PROMPT_TEMPLATE = """You are a professional subtitle translator.
 
 CRITICAL RULES:
 - Maintain exact tone and emotion (casual/formal/childish/aggressive/romantic)
@@ -315,21 +719,83 @@ Translate from {source_lang} to {target_lang}:
 
 {combined}"""
 
+@lru_cache(maxsize=64)
+def ai_prompt_head(source_lang, target_lang):
+    """Phần prompt cố định theo cặp ngôn ngữ, format 1 lần; mỗi batch chỉ nối thêm các dòng"""
+    head, _ = AI_PROMPT_TEMPLATE.split('{combined}')
+    return head.format(source_lang=source_lang, target_lang=target_lang)
+
+# Tiền tố "[i] " dựng sẵn (batch AI tối đa vài chục dòng), khỏi format lại mỗi batch
+BATCH_INDEX_PREFIXES = [f"[{i}] " for i in range(1, 101)]
+
+def build_batch_prompt(texts, source_lang, target_lang):
+    if len(texts) <= len(BATCH_INDEX_PREFIXES):
+        combined = '\n'.join(map(str.__add__, BATCH_INDEX_PREFIXES, texts))
+    else:
+        combined = '\n'.join(f"[{i}] {text}" for i, text in enumerate(texts, 1))
+    return ai_prompt_head(source_lang, target_lang) + combined
+
+def openai_chat_body(prompt):
+    return {'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': prompt}],
+            'temperature': 0.3, 'max_tokens': 2000}
+
+def parse_batch_reply(result, count):
+    """
+    Ghép theo số thứ tự [i] thay vì theo vị trí: AI bỏ sót dòng thì chỉ dòng đó trả về None
+    (caller gửi lại / giữ bản gốc), các dòng khác vẫn dùng được
+    Reply sai format (nhiều mục dồn 1 dòng "[1] a, [2] b", index lạ) -> None cho cả batch, không cache gì
+    """
+    pairs = BATCH_REPLY_RE.findall(result.replace('\r\n', '\n'))
+    by_index = {int(i): text.strip() for i, text in pairs}
+    if any(BATCH_INDEX_RE.search(text) for text in by_index.values()) or not by_index.keys() <= set(range(1, count + 1)):
+        logger.warning(f"AI reply format mismatch ({len(by_index)}/{count} entries), discarding batch")
+        return [None] * count
+    # Dòng trống trong bản dịch sẽ cắt đôi block SRT (và nằm trong cache 7 ngày) -> coi như không dịch được
+    return [text if text and '\n\n' not in text else None
+            for text in map(by_index.get, range(1, count + 1))]
+
+def translate_batch(texts, source_lang, target_lang, provider, api_key, retry_count=0, resend_missing=True):
+    """Dịch 1 batch qua AI, trả về list cùng độ dài texts (None ở dòng không dịch được)"""
+    results = request_batch(texts, source_lang, target_lang, provider, api_key, retry_count)
+    
+    # AI bỏ sót vài dòng -> gửi lại đúng các dòng đó 1 lần thay vì bỏ cả batch
+    missing = [i for i, translated in enumerate(results) if translated is None]
+    if resend_missing and 0 < len(missing) < len(texts):
+        try:
+            retried = translate_batch([texts[i] for i in missing], source_lang, target_lang,
+                                      provider, api_key, resend_missing=False)
+            for i, translated in zip(missing, retried):
+                results[i] = translated
+        except Exception as e:
+            logger.warning(f"Resending {len(missing)} missing lines failed: {e}")
+    return results
+
+def request_batch(texts, source_lang, target_lang, provider, api_key, retry_count=0):
+    prompt = build_batch_prompt(texts, source_lang, target_lang)
+
+    retry_after = None
     try:
+        # Body serialize bằng orjson (ra bytes luôn), thay cho json= của requests
         if provider == 'groq':
-            resp = requests.post(GROQ_API, headers={'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'},
-                                 json={'model': 'llama-3.3-70b-versatile', 'messages': [{'role': 'user', 'content': prompt}],
-                                       'temperature': 0.3, 'max_tokens': 2000}, timeout=30)
+            url, headers = GROQ_API, {'Authorization': f'Bearer {api_key}'}
+            payload = {'model': 'llama-3.3-70b-versatile', 'messages': [{'role': 'user', 'content': prompt}],
+                       'temperature': 0.3, 'max_tokens': 2000}
         elif provider == 'gemini':
-            resp = requests.post(f"{GEMINI_API}?key={api_key}", headers={'Content-Type': 'application/json'},
-                                 json={'contents': [{'parts': [{'text': prompt}]}], 'generationConfig': {'temperature': 0.3, 'maxOutputTokens': 2000}},
-                                 timeout=30)
+            url, headers = f"{GEMINI_API}?key={api_key}", None
+            payload = {'contents': [{'parts': [{'text': prompt}]}], 'generationConfig': {'temperature': 0.3, 'maxOutputTokens': 2000}}
         else:
-            resp = requests.post(OPENAI_API, headers={'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'},
-                                 json={'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': prompt}],
-                                       'temperature': 0.3, 'max_tokens': 2000}, timeout=30)
+            url, headers = OPENAI_API, {'Authorization': f'Bearer {api_key}'}
+            payload = openai_chat_body(prompt)
+        wait_provider_pause(provider)
+        rpm_limiter = ai_limiters.get(provider)
+        if rpm_limiter:
+            rpm_limiter.acquire()
+        resp = ai_session.post(url, headers=headers, data=json_dumps(payload), timeout=30)
+        pause = update_provider_pause(provider, resp)
+        if resp.status_code == 429:
+            retry_after = pause
 
-        data = resp.json()
+        data = json_loads(resp.content)
         if 'error' in data:
             raise Exception(data['error'].get('message', 'API error'))
 
@@ -338,57 +804,90 @@ Translate from {source_lang} to {target_lang}:
         else:
             result = data.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
 
-        translations = []
-        for line in result.split('\n'):
-            m = re.match(r'\[(\d+)\]\s*(.*)', line.strip())
-            if m:
-                translations.append(m.group(2))
-
-        return translations if len(translations) == len(texts) else texts
+        return parse_batch_reply(result, len(texts))
 
     except Exception as e:
-        if retry_count < 3 and ('rate limit' in str(e).lower() or 'timeout' in str(e).lower()):
-            time.sleep((2 ** retry_count) * 2)
-            return translate_batch(texts, source_lang, target_lang, provider, api_key, retry_count + 1)
+        if retry_count < 3 and (retry_after or 'rate limit' in str(e).lower() or 'timeout' in str(e).lower()):
+            # Có header reset -> wait_provider_pause ở lần gọi sau tự chờ, không thì backoff
+            if not retry_after:
+                time.sleep(backoff_delay(retry_count, 2))
+            return request_batch(texts, source_lang, target_lang, provider, api_key, retry_count + 1)
         raise e
 
-def translate_subtitles(subtitles, source_lang, target_lang, provider, api_key, use_ai=True):
-    global current_progress, current_mode, total_subtitles, processed_subtitles
+def split_srt_tags(text):
+    """Tách tag bao ngoài (<i>, <font ...>, {\\an8}) khỏi nội dung cần dịch"""
+    # Phần lớn dòng không có tag -> bỏ qua regex (lazy match + backtrack khá tốn)
+    if '<' not in text and '{' not in text:
+        return '', text, ''
+    prefix, core, suffix = SRT_TAG_WRAP_RE.match(text).groups()
+    return prefix, core, suffix
+
+def needs_translation(text):
+    """Dòng chỉ có số / dấu câu / ký hiệu (♪, ..., - -) thì giữ nguyên"""
+    return LETTER_RE.search(text) is not None
+
+def translate_subtitles(subtitles, source_lang, target_lang, provider, api_key, use_ai=True, job=None):
+    job = job or JobProgress()
+    
+    # Bỏ tag bao ngoài trước khi dịch, gắn lại sau
+    parts = [split_srt_tags(sub['text']) for sub in subtitles]
+    
+    # Dedupe: chỉ dịch các text unique cần dịch, sau đó map ngược lại theo text
+    unique_texts = list(dict.fromkeys(core for _, core, _ in parts if needs_translation(core)))
+    result_map = {}
     
-    total_subtitles = len(subtitles)
-    processed_subtitles = 0
+    job.total = len(unique_texts)
+    job.done = 0
+    logger.info(f"Unique texts: {len(unique_texts)}/{len(subtitles)}")
     
-    if use_ai:
-        current_mode = "AI"
+    if not unique_texts:
+        logger.info("Nothing to translate")
+    elif use_ai:
+        job.mode = "AI"
         batch_size = 20 if provider == 'groq' else 12 if provider == 'openai' else 8
+        semaphore = ai_semaphores.get(provider, ai_semaphores['openai'])
         
-        for i in range(0, len(subtitles), batch_size):
-            batch = subtitles[i:i + batch_size]
-            texts = [sub['text'] for sub in batch]
-            try:
-                results = translate_batch(texts, source_lang, target_lang, provider, api_key)
-                for j, sub in enumerate(batch):
-                    sub['translated'] = results[j] if j < len(results) else sub['text']
-            except Exception as e:
-                logger.warning(f"Batch failed, using original: {e}")
-                for sub in batch:
-                    sub['translated'] = sub['text']
-            
-            processed_subtitles += len(batch)
-            with progress_lock:
-                current_progress = int((processed_subtitles / total_subtitles) * 100)
-            
-            time.sleep(0.3)
-    else:
-        current_mode = "Google Free"
-        texts = [sub['text'] for sub in subtitles]
-        results = translate_with_google_parallel(texts, source_lang, target_lang)
+        def translate_batch_limited(texts):
+            with semaphore:
+                try:
+                    return translate_batch(texts, source_lang, target_lang, provider, api_key)
+                except Exception as e:
+                    logger.warning(f"Batch failed, using original: {e}")
+                    return [None] * len(texts)
+                finally:
+                    job.incr(len(texts))
         
-        for j, sub in enumerate(subtitles):
-            sub['translated'] = results[j]
+        # Dòng lặp lại ("Yes.", tên nhân vật...) lấy từ cache theo provider, chỉ gửi phần miss
+        pending = []
+        for text, cached in zip(unique_texts, get_many_from_cache(unique_texts, source_lang, target_lang, provider)):
+            if cached:
+                result_map[text] = cached
+            else:
+                pending.append(text)
+        if result_map:
+            job.incr(len(result_map))
+            logger.info(f"AI cache hits: {len(result_map)}/{len(unique_texts)}")
+        
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        
+        # Các batch độc lập -> gửi song song, giới hạn theo provider
+        futures = {ai_executor.submit(translate_batch_limited, texts): texts for texts in batches}
+        
+        for future in as_completed(futures):
+            texts, results = futures[future], future.result()
+            # None = dòng không dịch được -> giữ bản gốc, không cache
+            translated_pairs = [(text, translated) for text, translated in zip(texts, results) if translated]
+            result_map.update(translated_pairs)
+            save_many_to_cache(translated_pairs, source_lang, target_lang, provider)
+    else:
+        job.mode = "Google Free"
+        results = translate_with_google_parallel(unique_texts, source_lang, target_lang, job)
+        result_map = dict(zip(unique_texts, results))
+    
+    for sub, (prefix, core, suffix) in zip(subtitles, parts):
+        sub['translated'] = prefix + result_map.get(core, core) + suffix
     
-    with progress_lock:
-        current_progress = 100
+    job.finished = True
     
     return subtitles
 
@@ -401,69 +900,98 @@ def index():
 @limiter.limit("10 per minute")
 def get_api_keys():
     try:
-        keys = {
-            'groq': mask_api_key(os.getenv('GROQ_API_KEY', '')),
-            'gemini': mask_api_key(os.getenv('GEMINI_API_KEY', '')),
-            'openai': mask_api_key(os.getenv('OPENAI_API_KEY', ''))
-        }
-        return jsonify(keys)
+        return jsonify(masked_keys)
     except Exception as e:
         logger.error(f"Error getting API keys: {str(e)}")
         return jsonify({'error': 'Failed to retrieve keys'}), 500
 
+# ==================== API KEY STORE ====================
+# Key giữ trong RAM (nạp từ env lúc khởi động), .env chỉ ghi nền khi save
+API_KEY_ENV_VARS = {'groq': 'GROQ_API_KEY', 'gemini': 'GEMINI_API_KEY', 'openai': 'OPENAI_API_KEY'}
+api_keys_store = {provider: os.getenv(var, '') for provider, var in API_KEY_ENV_VARS.items()}
+api_keys_lock = threading.Lock()
+env_file_lock = threading.Lock()
+
+def get_api_key(provider):
+    return api_keys_store.get(provider) or os.getenv(API_KEY_ENV_VARS.get(provider, ''), '')
+
+def persist_api_key(provider):
+    """
+    Ghi key của provider ra .env ở background thread, lock để các lần save không ghi đè lẫn nhau
+    Đọc giá trị hiện tại trong store (không dùng giá trị lúc tạo thread): 2 lần save liên tiếp
+    có thể vào lock ngược thứ tự, thread đến sau vẫn ghi key mới nhất
+    """
+    var_name = API_KEY_ENV_VARS[provider]
+    try:
+        with env_file_lock:
+            with api_keys_lock:
+                api_key = api_keys_store[provider]
+            update_env_variable(var_name, api_key)
+    except Exception as e:
+        logger.error(f"Error persisting {var_name} to .env: {str(e)}")
+
+@lru_cache(maxsize=256)
 def mask_api_key(key):
     if not key or len(key) < 8:
         return ''
     return f"{key[:4]}...{key[-4:]}"
 
+# Masked keys tính sẵn 1 lần, /save-api-key cập nhật đúng provider đó
+masked_keys = {provider: mask_api_key(get_api_key(provider)) for provider in API_KEY_ENV_VARS}
+
+ENV_VAR_LINE_RE = re.compile(r'^[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)[ \t]*=')
+
 def update_env_variable(var_name, var_value):
     """
     Cập nhật chính xác 1 biến trong .env file
     - Giữ nguyên các biến khác
     - Giữ nguyên comments
     - Tạo file mới nếu chưa tồn tại
+    - Ghi atomic (file tạm + os.replace): crash giữa chừng không làm hỏng .env
     """
     env_file = find_dotenv() or os.path.join(os.getcwd(), '.env')
+    new_line = f'{var_name}={var_value}\n'
     
-    # Đọc nội dung hiện tại
     lines = []
-    var_found = False
-    
     if os.path.exists(env_file):
         with open(env_file, 'r', encoding='utf-8') as f:
             lines = f.readlines()
     
-    # Cập nhật hoặc thêm biến
-    new_lines = []
-    for line in lines:
-        stripped = line.strip()
-        
-        # Nếu là dòng của biến cần update
-        if stripped and not stripped.startswith('#'):
-            if '=' in stripped:
-                current_var = stripped.split('=', 1)[0].strip()
-                if current_var == var_name:
-                    # Tìm thấy -> update value
-                    if var_value:
-                        new_lines.append(f'{var_name}={var_value}\n')
-                    else:
-                        new_lines.append(f'{var_name}=\n')
-                    var_found = True
-                    continue
-        
-        # Giữ nguyên các dòng khác
-        new_lines.append(line)
+    # Thay dòng của biến cần update (comment không match regex nên được giữ nguyên)
+    var_found = False
+    for i, line in enumerate(lines):
+        match = ENV_VAR_LINE_RE.match(line)
+        if match and match.group(1) == var_name:
+            lines[i] = new_line
+            var_found = True
     
     # Nếu chưa tồn tại -> thêm vào cuối
     if not var_found:
-        if var_value:
-            new_lines.append(f'{var_name}={var_value}\n')
-        else:
-            new_lines.append(f'{var_name}=\n')
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append(new_line)
     
-    # Ghi lại file
-    with open(env_file, 'w', encoding='utf-8') as f:
-        f.writelines(new_lines)
+    # Ghi ra file tạm cùng thư mục rồi rename đè lên
+    # mkstemp tạo file 0600, file cũ có sẵn thì copy quyền của nó -> .env chứa key không bị lộ thành 0644
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(env_file) or '.', prefix='.env.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(env_file):
+            shutil.copymode(env_file, tmp_path)
+        try:
+            os.replace(tmp_path, env_file)
+        except OSError as e:
+            # .env bind-mount từng file (Docker) không rename đè được -> ghi thẳng vào file
+            if e.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            with open(env_file, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     
     logger.info(f"✅ Updated {var_name} in .env")
 
@@ -480,32 +1008,32 @@ def save_api_key():
         if api_key and not validate_api_key_format(provider, api_key):
             return jsonify({'error': f'Invalid API key format for {provider}'}), 400
 
-        env_var_map = {'groq': 'GROQ_API_KEY', 'gemini': 'GEMINI_API_KEY', 'openai': 'OPENAI_API_KEY'}
-        env_var_name = env_var_map.get(provider)
+        env_var_name = API_KEY_ENV_VARS.get(provider)
         if not env_var_name:
             return jsonify({'error': 'Invalid provider'}), 400
 
-        # Dùng helper function để update chính xác
-        update_env_variable(env_var_name, api_key)
-        
-        # Reload environment variables
-        load_dotenv(override=True)
+        # Cập nhật store trong RAM + runtime environment
+        with api_keys_lock:
+            api_keys_store[provider] = api_key
+            if api_key:
+                os.environ[env_var_name] = api_key
+            elif env_var_name in os.environ:
+                del os.environ[env_var_name]
+            masked_keys[provider] = mask_api_key(api_key)
 
-        # Cập nhật runtime environment
-        if api_key:
-            os.environ[env_var_name] = api_key
-        elif env_var_name in os.environ:
-            del os.environ[env_var_name]
+        # Ghi .env ở background, không chặn response
+        threading.Thread(target=persist_api_key, args=(provider,), daemon=True).start()
 
         return jsonify({
             'success': True,
             'message': f'{provider.upper()} API key saved',
-            'masked_key': mask_api_key(api_key) if api_key else ''
+            'masked_key': masked_keys[provider]
         })
     except Exception as e:
         logger.error(f"Error saving API key: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@lru_cache(maxsize=256)
 def validate_api_key_format(provider, key):
     if not key:
         return True
@@ -520,36 +1048,36 @@ def validate_api_key_format(provider, key):
 @app.route('/progress', methods=['GET'])
 @limiter.limit("200 per minute")
 def get_progress():
-    global current_progress, current_mode, total_subtitles, processed_subtitles
-    with progress_lock:
-        processed_str = ""
-        if total_subtitles > 0:
-            processed_str = f"{processed_subtitles}/{total_subtitles}"
-        
-        return jsonify({
-            'progress': current_progress,
-            'status': 'Đang xử lý...' if current_progress < 100 else 'Hoàn tất!',
-            'mode': current_mode,
-            'processed': processed_str
-        })
+    job = current_job
+    processed_str = ""
+    if job.total > 0:
+        processed_str = f"{job.done}/{job.total}"
+    
+    progress = job.percent
+    return jsonify({
+        'progress': progress,
+        'status': 'Đang xử lý...' if progress < 100 else 'Hoàn tất!',
+        'mode': job.mode,
+        'processed': processed_str
+    })
 
 @app.route('/translate', methods=['POST'])
 @limiter.limit("10 per minute")
 def translate():
-    global current_progress, current_mode, total_subtitles, processed_subtitles
+    global current_job
     
-    with progress_lock:
-        current_progress = 0
-        current_mode = "Google Free"
-        total_subtitles = 0
-        processed_subtitles = 0
+    job = current_job = JobProgress()
 
     try:
+        # Từ chối sớm theo Content-Length, trước khi parse multipart / đọc file
+        if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': 'File too large (max 16MB)'}), 413
+
         file = request.files.get('file')
         source_lang = request.form.get('source_lang', 'auto')
         target_lang = request.form.get('target_lang')
         provider = request.form.get('provider', 'groq')
-        api_key = request.form.get('api_key')
+        api_key = request.form.get('api_key') or get_api_key(provider)
         use_ai = request.form.get('use_ai', 'true').lower() == 'true'
 
         if not file or not target_lang:
@@ -557,33 +1085,43 @@ def translate():
         if not file.filename.endswith('.srt'):
             return jsonify({'error': 'Only .srt files are allowed'}), 400
 
-        content = file.read().decode('utf-8')
-        subtitles = parse_srt(content)
+        # Decode + parse trực tiếp từ stream theo chunk, bỏ BOM nếu có
+        # (byte lỗi thay bằng U+FFFD thay vì làm hỏng cả request)
+        # Lấy tối đa MAX + 1 entry: vượt giới hạn thì dừng đọc ngay, không parse phần còn lại
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', errors='replace')
+        subtitles = list(itertools.islice(parse_srt_stream(stream), MAX_SUBTITLE_ENTRIES + 1))
 
         if not subtitles:
             return jsonify({'error': 'No valid subtitles found'}), 400
-        if len(subtitles) > 50000:
-            return jsonify({'error': 'Too many subtitle entries (max 50000)'}), 400
+        if len(subtitles) > MAX_SUBTITLE_ENTRIES:
+            return jsonify({'error': f'Too many subtitle entries (max {MAX_SUBTITLE_ENTRIES})'}), 400
 
         logger.info(f"Translating {len(subtitles)} subtitles → {target_lang} (AI: {use_ai})")
 
-        current_mode = "AI" if use_ai else "Google Free"
-        total_subtitles = len(subtitles)
+        job.mode = "AI" if use_ai else "Google Free"
+        job.total = len(subtitles)
 
-        translated_subs = translate_subtitles(subtitles, source_lang, target_lang, provider, api_key, use_ai)
-        translated_content = build_srt(translated_subs)
-
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.srt', dir=tempfile.gettempdir())
-        temp_file.write(translated_content.encode('utf-8'))
-        temp_file.close()
+        translated_subs = translate_subtitles(subtitles, source_lang, target_lang, provider, api_key, use_ai, job)
 
         original_filename = file.filename.rsplit('.', 1)[0]
         translated_filename = f"{original_filename}_{target_lang}.srt"
+
+        # ?stream=1: trả file SRT trực tiếp, không qua temp file + /download
+        if request.args.get('stream') == '1':
+            return Response(build_srt_chunks(translated_subs), mimetype='application/x-subrip',
+                            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(translated_filename)}"})
+
+        # Ghi từng block ra file qua buffer 1MB, không giữ toàn bộ nội dung SRT trong RAM
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.srt')
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
+            f.writelines(build_srt_iter(translated_subs))
+        register_temp_file(temp_path)
+
         preview_lines = '\n'.join([sub['translated'] for sub in translated_subs[:5]])
 
         return jsonify({
             'preview': preview_lines,
-            'file_path': os.path.basename(temp_file.name),
+            'file_path': os.path.basename(temp_path),
             'filename': translated_filename
         })
 
@@ -591,75 +1129,250 @@ def translate():
         logger.error(f"Translation error: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/translate-batch-json', methods=['POST'])
+@limiter.limit("30 per minute")
+def translate_batch_json():
+    """
+    Dịch 1 mảng text trong 1 request (cho client tích hợp pipeline)
+    Body: {"texts": [...], "target_lang": "vi", "source_lang": "auto", "use_ai": false, "provider": "groq", "api_key": "..."}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Body must be a JSON object'}), 400
+        texts = data.get('texts')
+        target_lang = data.get('target_lang')
+        source_lang = data.get('source_lang', 'auto')
+        provider = data.get('provider', 'groq')
+        use_ai = data.get('use_ai', False)
+
+        if not isinstance(texts, list) or not target_lang:
+            return jsonify({'error': 'Missing required fields'}), 400
+        # "false" / "0" là chuỗi truthy -> chỉ nhận boolean thật
+        if not isinstance(use_ai, bool):
+            return jsonify({'error': 'use_ai must be a boolean'}), 400
+        if use_ai and provider not in API_KEY_ENV_VARS:
+            return jsonify({'error': 'Invalid provider'}), 400
+        if not all(isinstance(text, str) for text in texts):
+            return jsonify({'error': 'texts must be a list of strings'}), 400
+        if len(texts) > BATCH_JSON_MAX_TEXTS:
+            return jsonify({'error': f'Too many texts (max {BATCH_JSON_MAX_TEXTS})'}), 400
+        api_key = data.get('api_key') or get_api_key(provider)
+
+        # Đi qua translate_subtitles: dedupe + cache + giữ tag giống /translate (job riêng, không đụng /progress)
+        subtitles = translate_subtitles([{'text': text} for text in texts], source_lang, target_lang,
+                                        provider, api_key, use_ai, JobProgress())
+        return jsonify({'translations': [sub['translated'] for sub in subtitles]})
+
+    except Exception as e:
+        logger.error(f"Batch JSON translation error: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/download/<path:file_path>', methods=['GET'])
 def download(file_path):
     try:
+        # Chỉ phục vụ file temp của app (không cho đi ra ngoài temp dir)
+        if os.path.basename(file_path) != file_path or not file_path.startswith(TEMP_PREFIX):
+            return jsonify({'error': 'File not found'}), 404
+
         full_path = os.path.join(tempfile.gettempdir(), file_path)
         if not os.path.exists(full_path):
             logger.error(f"File not found: {full_path}")
             return jsonify({'error': 'File not found'}), 404
 
+        def cleanup_temp_file():
+            try:
+                os.unlink(full_path)
+                logger.info(f"Deleted temp file: {full_path}")
+            except OSError as e:
+                logger.warning(f"Failed to delete temp file: {e}")
+            forget_temp_file(full_path)
+
+        # send_file tạo iterable qua environ['wsgi.file_wrapper'] -> thay bằng subclass xóa được file,
+        # vẫn là instance của wrapper gốc nên gunicorn giữ được sendfile (zero-copy)
+        wrapper_cls = deleting_file_wrapper(request.environ.get('wsgi.file_wrapper', FileWrapper))
+        request.environ['wsgi.file_wrapper'] = wrapper_cls
+
         filename = request.args.get('filename', 'translated.srt')
-        response = send_file(full_path, as_attachment=True, download_name=filename)
+        response = send_file(full_path, as_attachment=True, download_name=filename,
+                             conditional=True, max_age=0)
+        # Xóa file khi server đã gửi xong body và đóng iterable (không phải lúc after_request,
+        # lúc đó body chưa stream). Chỉ xóa sau 1 body đầy đủ (GET 200):
+        # HEAD / 304 / 206 Range thì client còn tải tiếp
+        if request.method == 'GET' and response.status_code == 200 and isinstance(response.response, wrapper_cls):
+            response.response.on_close = cleanup_temp_file
         return response
     except Exception as e:
         logger.error(f"Download error: {str(e)}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        try:
-            if os.path.exists(full_path):
-                os.unlink(full_path)
-                logger.info(f"Deleted temp file: {full_path}")
-        except Exception as e:
-            logger.warning(f"Failed to delete temp file: {e}")
 
 def parse_srt(content):
+    """Parse SRT bằng 1 regex duy nhất, fallback parser từng dòng nếu không match"""
+    subtitles = [
+        {'index': index, 'timing': timing.strip(), 'text': clean_srt_text(text)}
+        for index, timing, text in SRT_BLOCK_RE.findall(content.replace('\r\n', '\n'))
+    ]
+    return subtitles or parse_srt_lines(content)
+
+def parse_srt_stream(stream, chunk_size=1 << 20):
+    """
+    Parse SRT từ text stream theo từng chunk (~1MB)
+    Chỉ giữ lại phần block chưa hoàn chỉnh ở cuối chunk (cắt tại dòng trống)
+    """
+    carry = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer = carry + chunk
+        cut = buffer.rfind('\n\n')
+        if cut == -1:
+            carry = buffer
+            continue
+        yield from parse_srt(buffer[:cut + 1])
+        carry = buffer[cut + 2:]
+    if carry.strip():
+        yield from parse_srt(carry)
+
+def clean_srt_text(text):
+    """Strip từng dòng, chỉ tách dòng khi thật sự có khoảng trắng thừa"""
+    text = text.strip()
+    if ' \n' in text or '\n ' in text or '\t' in text or '\r' in text:
+        return '\n'.join(map(str.strip, text.split('\n')))
+    return text
+
+def parse_srt_lines(content):
+    """Parser từng dòng (cho file SRT lỗi định dạng)"""
     subtitles = []
-    lines = content.split('\n')
+    lines = [line.strip() for line in content.split('\n')]
     i = 0
     while i < len(lines):
-        if lines[i].strip().isdigit():
-            index = lines[i].strip()
+        if SRT_INDEX_RE.match(lines[i]):
+            index = lines[i]
             i += 1
             if i < len(lines) and '-->' in lines[i]:
-                timing = lines[i].strip()
+                timing = lines[i]
                 i += 1
-                text = ''
-                while i < len(lines) and lines[i].strip():
-                    text += lines[i].strip() + '\n'
+                text_parts = []
+                while i < len(lines) and lines[i]:
+                    text_parts.append(lines[i])
                     i += 1
-                subtitles.append({'index': index, 'timing': timing, 'text': text.strip()})
-            else:
-                i += 1
+                subtitles.append({'index': index, 'timing': timing, 'text': '\n'.join(text_parts)})
+            # Không có timing: dòng hiện tại (có thể là index thật) được xét lại ở vòng sau
         else:
             i += 1
     return subtitles
 
-def build_srt(subtitles):
-    srt = ''
+def build_srt_iter(subtitles):
+    """Sinh từng block SRT, dùng để ghi thẳng ra file không cần dựng cả chuỗi"""
     for sub in subtitles:
         translated_text = sub.get('translated') or sub.get('text') or ''
-        srt += sub.get('index', '') + '\n'
-        srt += sub.get('timing', '') + '\n'
-        srt += translated_text + '\n\n'
-    return srt
+        yield f"{sub.get('index', '')}\n{sub.get('timing', '')}\n{translated_text}\n\n"
+
+def build_srt_chunks(subtitles, chunk_size=1 << 16):
+    """Gom các block thành chunk ~64KB cho streaming response (tránh mỗi block 1 lần write socket)"""
+    buffer, size = [], 0
+    for block in build_srt_iter(subtitles):
+        buffer.append(block)
+        size += len(block)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def build_srt(subtitles):
+    return ''.join(build_srt_iter(subtitles))
+
+# ==================== TEMP FILE CLEANUP ====================
+TEMP_PREFIX = 'trsrt_'
+TEMP_FILE_TTL = 3600       # File chưa download sau 1 giờ sẽ bị xóa
+TEMP_SWEEP_INTERVAL = 600  # Quét mỗi 10 phút
+
+own_temp_files = {}  # path -> thời điểm tạo
+own_temp_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def deleting_file_wrapper(base):
+    """
+    Subclass của wsgi.file_wrapper của server: close() đóng file rồi gọi on_close (nếu có)
+    gunicorn gán close = filelike.close trên instance -> phải gán đè sau __init__ chứ không override method
+    """
+    class DeletingFileWrapper(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.on_close = None
+            self.close_file = self.close
+            self.close = self.close_and_cleanup
+        
+        def close_and_cleanup(self):
+            self.close_file()
+            on_close, self.on_close = self.on_close, None
+            if on_close:
+                on_close()
+    
+    return DeletingFileWrapper
+
+def register_temp_file(path):
+    with own_temp_lock:
+        own_temp_files[path] = time.time()
+
+def forget_temp_file(path):
+    with own_temp_lock:
+        own_temp_files.pop(path, None)
+
+def sweep_temp_files():
+    """Xóa các file temp do app tạo đã quá TTL"""
+    cutoff = time.time() - TEMP_FILE_TTL
+    with own_temp_lock:
+        expired = [path for path, created in own_temp_files.items() if created < cutoff]
+        for path in expired:
+            del own_temp_files[path]
+    
+    for path in expired:
+        try:
+            os.unlink(path)
+            logger.info(f"Cleaned up expired temp file: {os.path.basename(path)}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to cleanup {path}: {e}")
+
+def temp_sweeper():
+    # Lúc khởi động: dọn file sót lại từ process trước (crash / kill -9 không chạy atexit)
+    try:
+        cleanup_old_temp_files()
+    except Exception as e:
+        logger.warning(f"Temp startup cleanup error: {e}")
+    
+    while True:
+        time.sleep(TEMP_SWEEP_INTERVAL)
+        try:
+            sweep_temp_files()
+        except Exception as e:
+            logger.warning(f"Temp sweeper error: {e}")
 
 def cleanup_old_temp_files():
-    """Xóa file temp cũ hơn 1 giờ"""
-    temp_dir = tempfile.gettempdir()
-    now = time.time()
+    """Xóa file temp cũ hơn 1 giờ (chỉ file của app, prefix trsrt_)"""
+    cutoff = time.time() - TEMP_FILE_TTL
     
-    for filename in os.listdir(temp_dir):
-        if filename.endswith('.srt'):
-            filepath = os.path.join(temp_dir, filename)
-            try:
-                if os.path.getmtime(filepath) < now - 3600:
-                    os.unlink(filepath)
-                    logger.info(f"Cleaned up old temp file: {filename}")
-            except Exception as e:
-                logger.warning(f"Failed to cleanup {filename}: {e}")
+    # scandir: DirEntry có sẵn name/path, stat() được cache -> ít syscall hơn listdir + getmtime
+    with os.scandir(tempfile.gettempdir()) as entries:
+        for entry in entries:
+            if entry.name.startswith(TEMP_PREFIX) and entry.name.endswith('.srt'):
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        logger.info(f"Cleaned up old temp file: {entry.name}")
+                except OSError as e:
+                    logger.warning(f"Failed to cleanup {entry.name}: {e}")
 
 atexit.register(cleanup_old_temp_files)
+threading.Thread(target=temp_sweeper, daemon=True, name='temp-sweeper').start()
+
+@app.errorhandler(413)
+def too_large_handler(e):
+    return jsonify({'error': 'File too large (max 16MB)'}), 413
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
@@ -673,4 +1386,10 @@ def internal_error(e):
 if __name__ == '__main__':
     debug_mode = os.getenv('FLASK_ENV') == 'development'
     port = int(os.getenv('PORT', 5000))
-    app.run(debug=debug_mode, host='0.0.0.0', port=port, threaded=True)
+    if os.getenv('WORKER') == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        logger.info(f"🚀 gevent WSGIServer listening on 0.0.0.0:{port}")
+        WSGIServer(('0.0.0.0', port), app).serve_forever()
+    else:
+        logger.warning("⚠️ Werkzeug dev server - production dùng: gunicorn -k gevent -w 1 wsgi:app")
+        app.run(debug=debug_mode, host='0.0.0.0', port=port, threaded=True)
@@ -0,0 +1,11 @@
+# wsgi.py - entrypoint cho production WSGI server
+#
+# gunicorn -k gevent -w 1 --worker-connections 1000 --timeout 120 -b 0.0.0.0:5000 wsgi:app
+#
+# Dùng 1 worker process: tiến độ job (/progress) và cache memory nằm trong process,
+# gevent worker đã cho phép hàng nghìn request đồng thời trên 1 process.
+
+from app import app
+
+if __name__ == '__main__':
+    app.run()